@@ -3,6 +3,7 @@
 # pylint: disable=unused-variable
 
 import json
+import re
 import traceback
 import csv
 from io import StringIO
@@ -10,6 +11,7 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from sqlalchemy import create_engine, text, MetaData
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
 from openai import OpenAI
 import sshtunnel
 from paramiko import SSHClient, AutoAddPolicy, RSAKey
@@ -22,6 +24,13 @@ tunnel = None
 metadata = MetaData()
 schema_dict = {}
 
+# Pre-flight defaults, can be overridden per request with a "preflight" dict
+default_max_cost = 1000000  # planner cost units
+default_max_rows = 1000000  # estimated rows of the top plan node
+default_row_limit = 1000  # LIMIT injected into interactive queries
+default_sql_retries = 0  # extra GPT attempts when generated SQL fails validation
+explainable_keywords = {"select", "with", "values", "table", "insert", "update", "delete", "merge"}
+
 #start FastAPI
 app = FastAPI()
 
@@ -144,7 +153,10 @@ def get_data(body: dict):
 
     try:
         with engine.connect() as connection:
-            result = connection.execute(text(raw_query))
+            query_sql, warnings = preflight_query(
+                connection, raw_query, body.get("preflight"), body.get("interactive", False)
+            )
+            result = connection.execute(text(query_sql))
             rows = [row._mapping for row in result]
 
             if(not history):  # pragma: no cover
@@ -154,16 +166,219 @@ def get_data(body: dict):
 
             if rows:
                 create_csv(rows)
-                return {"message": "Query executed successfully.", "data": rows}
+                return {"message": "Query executed successfully.", "data": rows,
+                        "warnings": warnings}
             
-            return {"message": "Query Returned 0 Matches", "data": rows}
+            return {"message": "Query Returned 0 Matches", "data": rows, "warnings": warnings}
 
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e)) from e
 
+# -------------------------------------------------
+# Pre-flight check
+#   - Runs EXPLAIN (FORMAT JSON) before a query is executed, so malformed SQL
+#     fails at planning time and expensive plans can be stopped.
+#   - preflight settings (all optional):
+#       maxCost, maxRows: thresholds on the planner's estimates
+#       onExceed: "reject" (default) raises a 400, "warn" returns warnings
+#       rowLimit: LIMIT wrapped around interactive read queries
+#   - Only single statements that EXPLAIN accepts are checked (no CREATE, SET, COPY...),
+#     and only on PostgreSQL. Everything else is passed through unchanged.
+#   - Statements are split by a small scanner that understands '...', E'...', "...",
+#     $tag$...$tag$, -- and nested /* */ comments.
+# -------------------------------------------------
+def parse_preflight_settings(settings: dict = None) -> dict:
+    settings = settings or {}
+    parsed = {}
+    for key, default, cast in (("maxCost", default_max_cost, float),
+                               ("maxRows", default_max_rows, float),
+                               ("rowLimit", default_row_limit, int)):
+        value = settings.get(key, default)
+        try:
+            if isinstance(value, bool):
+                raise ValueError
+            parsed[key] = cast(value)
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400,
+                                detail=f"Invalid preflight setting {key}: {value!r}") from e
+        if parsed[key] < (1 if key == "rowLimit" else 0):
+            raise HTTPException(status_code=400,
+                                detail=f"Invalid preflight setting {key}: {value!r}")
+
+    parsed["onExceed"] = settings.get("onExceed", "reject")
+    if parsed["onExceed"] not in {"reject", "warn"}:
+        raise HTTPException(status_code=400,
+                            detail=f"Invalid preflight setting onExceed: {parsed['onExceed']!r}")
+    return parsed
+
+def find_quote_end(query_sql: str, start: int, quote: str, backslash: bool = False) -> int:
+    i = start + 1
+    while i < len(query_sql):
+        if backslash and query_sql[i] == "\\":
+            i += 2
+        elif query_sql.startswith(quote * 2, i):
+            i += 2
+        elif query_sql[i] == quote:
+            return i + 1
+        else:
+            i += 1
+    return len(query_sql)
+
+def find_comment_end(query_sql: str, start: int) -> int:
+    depth = 0
+    i = start
+    while i < len(query_sql):
+        if query_sql.startswith("/*", i):
+            depth += 1
+            i += 2
+        elif query_sql.startswith("*/", i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return i
+        else:
+            i += 1
+    return len(query_sql)
+
+def scan_sql(query_sql: str):
+    # Yields (text, is_quoted) chunks, dropping comments
+    i = 0
+    while i < len(query_sql):
+        char = query_sql[i]
+        previous = query_sql[i - 1] if i else " "
+        dollar = re.match(r"\$([A-Za-z_]\w*)?\$", query_sql[i:])
+        if query_sql.startswith("--", i):
+            end = query_sql.find("\n", i)
+            end = len(query_sql) if end == -1 else end
+        elif query_sql.startswith("/*", i):
+            end = find_comment_end(query_sql, i)
+            yield " ", False
+        elif dollar and not (previous.isalnum() or previous in {"_", "$"}):
+            tag_end = query_sql.find(dollar.group(0), i + len(dollar.group(0)))
+            end = len(query_sql) if tag_end == -1 else tag_end + len(dollar.group(0))
+            yield query_sql[i:end], True
+        elif char in {"'", '"'}:
+            escaped = char == "'" and previous in {"e", "E"} and (
+                i < 2 or not (query_sql[i - 2].isalnum() or query_sql[i - 2] == "_"))
+            end = find_quote_end(query_sql, i, char, escaped)
+            yield query_sql[i:end], True
+        else:
+            end = i + 1
+            yield char, False
+        i = end
+
+def split_statements(query_sql: str) -> list:
+    # Splits on top-level semicolons, dropping comments but keeping quoted text intact
+    statements = []
+    current = []
+    for chunk, quoted in scan_sql(query_sql):
+        if chunk == ";" and not quoted:
+            statements.append("".join(current))
+            current = []
+        else:
+            current.append(chunk)
+    statements.append("".join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+def mask_quoted(statement: str) -> str:
+    return "".join(" " if quoted else chunk for chunk, quoted in scan_sql(statement))
+
+def get_statement_keyword(statement: str) -> str:
+    keyword = re.match(r"[\s(]*([a-z]*)", statement.lower())
+    return keyword.group(1)
+
+def get_explainable_statement(query_sql: str):
+    statements = split_statements(query_sql)
+    if len(statements) != 1:
+        return None
+    if get_statement_keyword(statements[0]) not in explainable_keywords:
+        return None
+    return statements[0]
+
+def explain_query(connection, query_sql: str) -> dict:
+    result = connection.execute(text(f"EXPLAIN (FORMAT JSON) {query_sql}"))
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+def has_modify_table(plan: dict) -> bool:
+    if plan.get("Node Type") == "ModifyTable":
+        return True
+    return any(has_modify_table(child) for child in plan.get("Plans", []))
+
+def is_read_only(statement: str, plan: dict) -> bool:
+    # SELECT ... INTO creates a table but plans like a plain SELECT
+    if re.search(r"\binto\b", mask_quoted(statement), re.IGNORECASE):
+        return False
+    return not has_modify_table(plan)
+
+def inject_limit(statement: str, row_limit: int) -> str:
+    return f"SELECT * FROM ({statement}) AS _q LIMIT {int(row_limit)}"
+
+def preflight_query(connection, query_sql: str, settings: dict = None,
+                    interactive: bool = False) -> tuple:
+    settings = parse_preflight_settings(settings)
+    statement = get_explainable_statement(query_sql)
+    if connection.dialect.name != "postgresql" or statement is None:
+        return query_sql, []
+
+    plan = explain_query(connection, statement)
+    if interactive and is_read_only(statement, plan):
+        query_sql = statement = inject_limit(statement, settings["rowLimit"])
+        plan = explain_query(connection, statement)
+
+    warnings = []
+    if plan["Total Cost"] > settings["maxCost"]:
+        warnings.append(f"Estimated cost {plan['Total Cost']:.0f} exceeds limit "
+                        f"{settings['maxCost']:.0f}.")
+    if plan["Plan Rows"] > settings["maxRows"]:
+        warnings.append(f"Estimated rows {plan['Plan Rows']:.0f} exceeds limit "
+                        f"{settings['maxRows']:.0f}.")
+
+    if warnings and settings["onExceed"] != "warn":
+        raise HTTPException(status_code=400,
+                            detail="Query rejected by pre-flight check: " + " ".join(warnings))
+    return query_sql, warnings
+
+# -------------------------------------------------
+# Validate SQL
+#   - Plans the query without executing it and returns (valid, error).
+#   - valid is None when nothing could be checked (no engine, not PostgreSQL,
+#     not a statement EXPLAIN accepts, or the database could not be reached).
+# -------------------------------------------------
+def validate_sql(query_sql: str, settings: dict = None) -> tuple:
+    if engine is None or engine.dialect.name != "postgresql":
+        return None, None
+    if get_explainable_statement(query_sql) is None:
+        return None, None
+    try:
+        connection = engine.connect()
+    except SQLAlchemyError:
+        traceback.print_exc()
+        return None, None
+
+    with connection:
+        try:
+            preflight_query(connection, query_sql, settings)
+        except HTTPException as e:
+            return False, e.detail
+        except DBAPIError as e:
+            if e.connection_invalidated:
+                traceback.print_exc()
+                return None, None
+            return False, str(e.orig or e).split("\n", maxsplit=1)[0]
+        connection.rollback()
+    return True, None
+
 # -------------------------------------------------
 # Ask GPT
+#   - With validateSql, the first line of the reply (where the prompt puts the SQL)
+#     is validated against the planner and, on failure, the error is sent back to
+#     GPT for up to sqlRetries corrections.
 # -------------------------------------------------
 @app.post("/ask_gpt")
 def ask_gpt(request: dict):  
@@ -177,26 +392,43 @@ def ask_gpt(request: dict):
         raise HTTPException(status_code=400, detail="Query is required.")
     if not settings or "apiKey" not in settings:
         raise HTTPException(status_code=400, detail="GPT API key is missing.")
+    preflight = parse_preflight_settings(request.get("preflight"))
 
-    try:  # pragma: no cover
+    try:
         client = OpenAI(api_key=settings["apiKey"])
-        response = client.chat.completions.create(
-            model=settings.get("model", default_gpt_model),
-            messages=[
-                {
-                    "role": "system",
-                    "content": ("You are an AI assistant for generating PostgreSQL queries from natural language. You have a database schema below. "
-                                "Rules: "
-                                "1) Output ONLY the SQL query on the first line (no code fences). "
-                                "2) Use \"table\".\"column\" for references, never \"table.column\". "
-                                "3) Only use the columns in the schema. Never make up columns. "
-                                "The json of the schema is as follows: ") + json.dumps(schema_dict),},
-
-                {"role": "user", "content": user_query},],
-            max_completion_tokens=int(settings.get("max_tokens", default_tokens))  # default=1000
-        )
-
-        return {"response": response.choices[0].message}
+        messages = [
+            {
+                "role": "system",
+                "content": ("You are an AI assistant for generating PostgreSQL queries from natural language. You have a database schema below. "
+                            "Rules: "
+                            "1) Output ONLY the SQL query on the first line (no code fences). "
+                            "2) Use \"table\".\"column\" for references, never \"table.column\". "
+                            "3) Only use the columns in the schema. Never make up columns. "
+                            "The json of the schema is as follows: ") + json.dumps(schema_dict),},
+
+            {"role": "user", "content": user_query},]
+        retries = max(0, int(settings.get("sqlRetries", default_sql_retries)))
+        validate = settings.get("validateSql", False)
+
+        for attempt in range(retries + 1):
+            response = client.chat.completions.create(
+                model=settings.get("model", default_gpt_model),
+                messages=list(messages),
+                max_completion_tokens=int(settings.get("max_tokens", default_tokens))  # default=1000
+            )
+            message = response.choices[0].message
+            valid, error = None, None
+            if validate:
+                sql = (message.content or "").strip().split("\n", maxsplit=1)[0]
+                valid, error = validate_sql(sql, preflight)
+            if valid is not False:
+                break
+            messages.append({"role": "assistant", "content": message.content})
+            messages.append({"role": "user", "content": f"The query failed validation: {error} "
+                                                        "Reply with a corrected query."})
+
+        return {"response": message, "validation": {"valid": valid, "error": error,
+                                                    "attempts": attempt + 1}}
     except Exception as e:  # pragma: no cover
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e)) from e
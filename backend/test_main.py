@@ -1,6 +1,10 @@
+import json
 from unittest.mock import patch
+import pytest
 from fastapi.testclient import TestClient
+from openai.types.chat import ChatCompletionMessage
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.pool import StaticPool
 from app import main
 from app.main import app
@@ -148,3 +152,261 @@ def test_no_schema_dict():
             self.tables = tables
     
     assert not main.get_clean_schema_dict(mock_metadata(None))
+
+class mock_dialect:
+    name = "postgresql"
+
+class mock_postgres_connection:
+    def __init__(self, total_cost, plan_rows, node_type="Seq Scan", plans=None, as_json=False):
+        plan = {"Node Type": node_type, "Total Cost": total_cost, "Plan Rows": plan_rows}
+        if plans:
+            plan["Plans"] = plans
+        self.plan = json.dumps([{"Plan": plan}]) if as_json else [{"Plan": plan}]
+        self.statements = []
+        self.dialect = mock_dialect()
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+        plan = self.plan
+
+        class mock_result:
+            def scalar(self):
+                return plan
+        return mock_result()
+
+    def rollback(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class mock_postgres_engine:
+    def __init__(self, conn=None, error=None):
+        self.conn = conn
+        self.error = error
+        self.dialect = mock_dialect()
+
+    def connect(self):
+        if self.error:
+            raise self.error
+        return self.conn
+
+def test_preflight_skips_non_postgres():
+    with engine.connect() as conn:
+        assert main.preflight_query(conn, "SELECT * FROM users", {}, True) == ("SELECT * FROM users", [])
+
+def test_preflight_within_limits():
+    conn = mock_postgres_connection(10.5, 2)
+    assert main.preflight_query(conn, "SELECT * FROM users") == ("SELECT * FROM users", [])
+    assert conn.statements == ["EXPLAIN (FORMAT JSON) SELECT * FROM users"]
+
+def test_preflight_json_string_plan():
+    conn = mock_postgres_connection(10.5, 2, as_json=True)
+    assert main.explain_query(conn, "SELECT 1")["Total Cost"] == 10.5
+
+def test_preflight_rejects_expensive_query():
+    conn = mock_postgres_connection(5000000, 10)
+    with pytest.raises(main.HTTPException) as e:
+        main.preflight_query(conn, "SELECT * FROM a, b", {"maxCost": 1000})
+    assert e.value.status_code == 400
+    assert e.value.detail == "Query rejected by pre-flight check: Estimated cost 5000000 exceeds limit 1000."
+
+def test_preflight_rejects_parenthesised_query():
+    conn = mock_postgres_connection(5000000, 10)
+    with pytest.raises(main.HTTPException):
+        main.preflight_query(conn, "(SELECT * FROM history a, history b) UNION (SELECT * FROM history)")
+
+def test_preflight_warns_on_expensive_query():
+    conn = mock_postgres_connection(10, 5000)
+    assert main.preflight_query(conn, "SELECT * FROM users", {"maxRows": "100", "onExceed": "warn"}) == (
+        "SELECT * FROM users", ["Estimated rows 5000 exceeds limit 100."])
+
+def test_preflight_invalid_settings():
+    for settings in ({"maxCost": "abc"}, {"maxRows": None}, {"rowLimit": 0},
+                     {"rowLimit": True}, {"onExceed": "ignore"}):
+        with pytest.raises(main.HTTPException) as e:
+            main.parse_preflight_settings(settings)
+        assert e.value.status_code == 400
+
+@patch('app.main.engine', new=engine)
+def test_get_data_invalid_preflight_settings():
+    response = client.post("/GetData", json={"query": "SELECT * FROM users", "history": True,
+                                             "preflight": {"maxCost": "abc"}})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid preflight setting maxCost: 'abc'"}
+
+def test_ask_gpt_invalid_preflight_settings():
+    response = client.post("/ask_gpt", json={"query": "help", "settings": {"apiKey": "key"},
+                                             "preflight": {"rowLimit": "ten"}})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid preflight setting rowLimit: 'ten'"}
+
+def test_preflight_passes_through_non_explainable_statements():
+    for query in ("CREATE TABLE t (id INTEGER)", "SET search_path TO history", "SHOW search_path",
+                  "SELECT 1; SELECT 2", "-- comment only"):
+        conn = mock_postgres_connection(5000000, 5000000)
+        assert main.preflight_query(conn, query, {}, True) == (query, [])
+        assert not conn.statements
+
+def test_preflight_wraps_limit_when_interactive():
+    conn = mock_postgres_connection(10, 2)
+    query, _ = main.preflight_query(conn, "SELECT * FROM users;", {"rowLimit": 50}, True)
+    assert query == "SELECT * FROM (SELECT * FROM users) AS _q LIMIT 50"
+    assert conn.statements == ["EXPLAIN (FORMAT JSON) SELECT * FROM users",
+                               "EXPLAIN (FORMAT JSON) SELECT * FROM (SELECT * FROM users) AS _q LIMIT 50"]
+
+def test_preflight_keeps_writes_when_interactive():
+    conn = mock_postgres_connection(10, 2, node_type="ModifyTable")
+    assert main.preflight_query(conn, "DELETE FROM users -- all", {}, True) == ("DELETE FROM users -- all", [])
+    assert conn.statements == ["EXPLAIN (FORMAT JSON) DELETE FROM users"]
+
+def test_preflight_keeps_with_insert_when_interactive():
+    query = "WITH n AS (SELECT 3 AS id) INSERT INTO users (id, name) SELECT id, 'x' FROM n"
+    conn = mock_postgres_connection(10, 2, node_type="ModifyTable")
+    assert main.preflight_query(conn, query, {}, True) == (query, [])
+    assert len(conn.statements) == 1
+
+def test_preflight_keeps_data_modifying_cte_when_interactive():
+    query = "WITH d AS (DELETE FROM users RETURNING *) SELECT * FROM d"
+    conn = mock_postgres_connection(10, 2, node_type="CTE Scan",
+                                    plans=[{"Node Type": "ModifyTable", "Plans": [{"Node Type": "Seq Scan"}]}])
+    assert main.preflight_query(conn, query, {}, True) == (query, [])
+    assert len(conn.statements) == 1
+
+def test_preflight_keeps_select_into_when_interactive():
+    query = "SELECT * INTO backup_users FROM users"
+    conn = mock_postgres_connection(10, 2)
+    assert main.preflight_query(conn, query, {}, True) == (query, [])
+    assert main.is_read_only("SELECT * FROM users WHERE name = 'into'", {"Node Type": "Seq Scan"})
+
+def test_inject_limit_ignores_comments():
+    statement = main.get_explainable_statement("SELECT * FROM users -- all users\n;")
+    assert main.inject_limit(statement, 10) == "SELECT * FROM (SELECT * FROM users) AS _q LIMIT 10"
+    statement = main.get_explainable_statement("SELECT * /* all /* nested */ ; */ FROM users")
+    assert main.inject_limit(statement, 10) == "SELECT * FROM (SELECT *   FROM users) AS _q LIMIT 10"
+
+def test_inject_limit_with_inner_limit():
+    statement = "SELECT * FROM (SELECT * FROM history LIMIT 5) a, history b"
+    assert main.inject_limit(statement, 10) == f"SELECT * FROM ({statement}) AS _q LIMIT 10"
+
+def test_inject_limit_with_limit_in_literal():
+    statement = main.get_explainable_statement("SELECT * FROM users WHERE name = 'no limit; -- here'")
+    assert statement == "SELECT * FROM users WHERE name = 'no limit; -- here'"
+    assert main.inject_limit(statement, 10) == f"SELECT * FROM ({statement}) AS _q LIMIT 10"
+
+def test_split_statements_quoting():
+    for query in ("SELECT $$a; b$$", "SELECT $tag$a; $$ b$tag$", "SELECT E'it\\'s; here'",
+                  "SELECT 'it''s; here'", 'SELECT 1 AS "a;b"', "SELECT 'open; quote"):
+        assert main.split_statements(query) == [query]
+    assert main.split_statements("SELECT $1; SELECT 2") == ["SELECT $1", "SELECT 2"]
+    assert main.split_statements("SELECT 1 /* open; comment") == ["SELECT 1"]
+
+@patch('app.main.preflight_query')
+@patch('app.main.engine', new=engine)
+def test_get_data_preflight_rejected(mock_preflight):
+    mock_preflight.side_effect = main.HTTPException(status_code=400, detail="Query rejected")
+    response = client.post("/GetData", json={"query": "SELECT * FROM users", "history": True})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Query rejected"}
+
+@patch('app.main.engine', new=mock_postgres_engine(mock_postgres_connection(10, 2)))
+def test_validate_sql():
+    assert main.validate_sql("SELECT * FROM users") == (True, None)
+
+@patch('app.main.engine', new=mock_postgres_engine(mock_postgres_connection(5000000, 2)))
+def test_validate_sql_rejected():
+    assert main.validate_sql("SELECT * FROM a, b") == (
+        False, "Query rejected by pre-flight check: Estimated cost 5000000 exceeds limit 1000000.")
+
+@patch('app.main.preflight_query')
+@patch('app.main.engine', new=mock_postgres_engine(mock_postgres_connection(10, 2)))
+def test_validate_sql_planner_error(mock_preflight):
+    mock_preflight.side_effect = ProgrammingError(
+        "SELECT nme FROM users", {}, Exception("column \"nme\" does not exist\nLINE 1"))
+    assert main.validate_sql("SELECT nme FROM users") == (False, "column \"nme\" does not exist")
+
+@patch('app.main.preflight_query')
+@patch('app.main.engine', new=mock_postgres_engine(mock_postgres_connection(10, 2)))
+def test_validate_sql_connection_lost(mock_preflight):
+    mock_preflight.side_effect = OperationalError(
+        "SELECT 1", {}, Exception("server closed the connection"), connection_invalidated=True)
+    assert main.validate_sql("SELECT 1") == (None, None)
+
+@patch('app.main.engine', new=mock_postgres_engine(error=OperationalError(
+    "connect", {}, Exception("could not connect to server"))))
+def test_validate_sql_connection_failed():
+    assert main.validate_sql("SELECT 1") == (None, None)
+
+@patch('app.main.engine', new=engine)
+def test_validate_sql_skipped_non_postgres():
+    assert main.validate_sql("SELECT * FROM users") == (None, None)
+
+@patch('app.main.engine', new=None)
+def test_validate_sql_skipped_no_engine():
+    assert main.validate_sql("SELECT 1") == (None, None)
+
+@patch('app.main.engine', new=mock_postgres_engine(mock_postgres_connection(10, 2)))
+def test_validate_sql_skipped_prose():
+    assert main.validate_sql("The history table stores completed queries.") == (None, None)
+
+def mock_gpt_replies(mock_openai, replies):
+    class mock_choice:
+        def __init__(self, content):
+            self.message = ChatCompletionMessage(role="assistant", content=content)
+
+    class mock_response:
+        def __init__(self, content):
+            self.choices = [mock_choice(content)]
+
+    create = mock_openai.return_value.chat.completions.create
+    create.side_effect = [mock_response(reply) for reply in replies]
+    return create
+
+gpt_settings = {"apiKey": "key", "validateSql": True, "sqlRetries": 2}
+
+@patch('app.main.validate_sql')
+@patch('app.main.OpenAI')
+def test_ask_gpt_valid_first_try(mock_openai, mock_validate):
+    create = mock_gpt_replies(mock_openai, ["SELECT * FROM users\nThis lists every user."])
+    mock_validate.return_value = (True, None)
+    response = client.post("/ask_gpt", json={"query": "all users", "settings": gpt_settings})
+    assert response.status_code == 200
+    assert response.json()["validation"] == {"valid": True, "error": None, "attempts": 1}
+    assert create.call_count == 1
+    mock_validate.assert_called_once_with("SELECT * FROM users", main.parse_preflight_settings())
+
+@patch('app.main.validate_sql')
+@patch('app.main.OpenAI')
+def test_ask_gpt_corrected_on_retry(mock_openai, mock_validate):
+    create = mock_gpt_replies(mock_openai, ["SELECT nme FROM users", "SELECT name FROM users"])
+    mock_validate.side_effect = [(False, "column \"nme\" does not exist"), (True, None)]
+    response = client.post("/ask_gpt", json={"query": "user names", "settings": gpt_settings})
+    assert response.json()["response"]["content"] == "SELECT name FROM users"
+    assert response.json()["validation"] == {"valid": True, "error": None, "attempts": 2}
+    feedback = create.call_args_list[1].kwargs["messages"][-2:]
+    assert feedback == [
+        {"role": "assistant", "content": "SELECT nme FROM users"},
+        {"role": "user", "content": "The query failed validation: column \"nme\" does not exist "
+                                    "Reply with a corrected query."}]
+
+@patch('app.main.validate_sql')
+@patch('app.main.OpenAI')
+def test_ask_gpt_invalid_after_retries(mock_openai, mock_validate):
+    create = mock_gpt_replies(mock_openai, ["SELECT a", "SELECT b", "SELECT c"])
+    mock_validate.return_value = (False, "syntax error")
+    response = client.post("/ask_gpt", json={"query": "anything", "settings": gpt_settings})
+    assert response.json()["response"]["content"] == "SELECT c"
+    assert response.json()["validation"] == {"valid": False, "error": "syntax error", "attempts": 3}
+    assert len(create.call_args_list[2].kwargs["messages"]) == 6
+
+@patch('app.main.validate_sql')
+@patch('app.main.OpenAI')
+def test_ask_gpt_validation_off_by_default(mock_openai, mock_validate):
+    create = mock_gpt_replies(mock_openai, ["The history table stores completed queries."])
+    response = client.post("/ask_gpt", json={"query": "help", "settings": {"apiKey": "key", "sqlRetries": -1}})
+    assert response.json()["validation"] == {"valid": None, "error": None, "attempts": 1}
+    assert create.call_count == 1
+    mock_validate.assert_not_called()